@@ -17,7 +17,9 @@ import torch.utils.checkpoint as cp
 from torch.distributed.fsdp.fully_sharded_data_parallel import CPUOffload
 from torch.distributed.fsdp import (
     FullyShardedDataParallel as FSDP,
-    MixedPrecision
+    MixedPrecision,
+    BackwardPrefetch,
+    ShardingStrategy,
 )
 
 from typing import Optional, Tuple, List, Dict
@@ -38,6 +40,12 @@ except ModuleNotFoundError:
     print ("xformers.ops ModuleNotFoundError")
     memory_efficient_attention, LowerTriangularMask, MemoryEfficientAttentionCutlassOp = None, None, None
 
+try:
+    from torchao.quantization import quantize_, int8_weight_only
+except ModuleNotFoundError:
+    print ("torchao ModuleNotFoundError")
+    quantize_, int8_weight_only = None, None
+
 from functools import partial
 
 from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
@@ -51,14 +59,21 @@ non_reentrant_wrapper = partial(
     checkpoint_impl=CheckpointImpl.NO_REENTRANT,
 )
 
-check_fn = lambda submodule: isinstance(submodule, TransformerBlock)
-
-
-def apply_fsdp_checkpointing(model):
+def apply_fsdp_checkpointing(model, ratio: float = 1.0):
     """apply activation checkpointing to model
     returns None as model is updated directly
+
+    ratio picks the fraction of transformer blocks to checkpoint:
+    1.0 recomputes every block, 0.5 every other block, 0 disables it
     """
-    print(f"--> applying fsdp activation checkpointing...")
+    if ratio <= 0:
+        return
+    print(f"--> applying fsdp activation checkpointing (ratio={ratio})...")
+
+    stride = max(1, int(1 / ratio))
+    check_fn = lambda submodule: (
+        isinstance(submodule, TransformerBlock) and submodule.layer_id % stride == 0
+    )
 
     apply_activation_checkpointing(
         model, checkpoint_wrapper_fn=non_reentrant_wrapper, check_fn=check_fn
@@ -72,13 +87,22 @@ def get_llama_wrapper():
     transformer_wrap_policy = functools.partial(
         transformer_auto_wrap_policy,
         transformer_layer_cls={
-            FeedForward,
+            TransformerBlock,
         },
     )
     auto_wrap_policy = transformer_wrap_policy
     # auto_wrap_policy = functools.partial(_or_policy, policies=[lambda_policy, transformer_wrap_policy])
     return auto_wrap_policy
 
+
+# built once at import time: the policy is identical for every wrap, so
+# there is no reason to reconstruct it per module
+_BF16_MIXED_PRECISION = MixedPrecision(
+    param_dtype=torch.bfloat16,
+    reduce_dtype=torch.float32,
+    buffer_dtype=torch.bfloat16,
+)
+
 class LLaMADecoder(FairseqDecoder):
 
     # TODO: change it to incremental decoder!!
@@ -87,14 +111,48 @@ class LLaMADecoder(FairseqDecoder):
         super().__init__(dictionary)
         model_args = ModelArgs(use_lora=use_lora, lora_r=lora_r, lora_alpha=lora_alpha,
                                use_xformers=use_xformers, enable_fsdp=enable_fsdp)
+        self.use_lora = use_lora
+        if enable_fsdp:
+            # compiled norm forwards cannot be traced through FSDP wrapping,
+            # so flip the fallback before the norms are constructed
+            RMSNorm.use_compile = False
         self.model_llama = LLAMA(model_args)
         # self.model_llama.load_state_dict(checkpoint, strict=False)
-        apply_fsdp_checkpointing(self.model_llama)
+        if enable_fsdp:
+            # shard whole transformer blocks (attention + norms included, not
+            # just the FFN) and prefetch the next block's all-gather so the
+            # communication overlaps with the current block's compute
+            self.model_llama = FSDP(
+                self.model_llama,
+                auto_wrap_policy=get_llama_wrapper(),
+                device_id=torch.cuda.current_device(),
+                sharding_strategy=ShardingStrategy.FULL_SHARD,
+                backward_prefetch=BackwardPrefetch.BACKWARD_PRE,
+                forward_prefetch=True,
+                limit_all_gathers=True,
+                use_orig_params=True,
+                mixed_precision=_BF16_MIXED_PRECISION,
+                # cpu_offload=CPUOffload(offload_params=True),
+            )
+        apply_fsdp_checkpointing(self.model_llama, model_args.activation_checkpoint_ratio)
 
     def forward(self, prev_output_tokens, audio_out, left_prompts=None):
         return self.model_llama(prev_output_tokens, audio_out, left_prompts), None
 
     def forward_generate(self, prev_output_tokens, start_pos, audio_out, left_prompts=None, incremental_state=None):
+        if isinstance(self.model_llama, FSDP):
+            # calling forward_generate through FSDP's __getattr__ bypasses
+            # FSDP.forward, so the root unit's params (embeddings, final
+            # norm, vocab projection) would still be local shard views;
+            # gather the full params for the duration of the call. The LoRA
+            # merge is skipped here because it mutates full-size weights,
+            # which writeback=False would silently discard.
+            with FSDP.summon_full_params(self.model_llama, writeback=False):
+                return self.model_llama.forward_generate(prev_output_tokens, start_pos, audio_out, left_prompts=left_prompts, incremental_state=incremental_state), None
+        if self.use_lora and not self.training:
+            # fold the adapters into the base weights once, so decoding runs
+            # the plain projections only; no-op after the first call
+            self.model_llama.merge_lora()
         return self.model_llama.forward_generate(prev_output_tokens, start_pos, audio_out, left_prompts=left_prompts, incremental_state=incremental_state), None
 
     def reorder_incremental_state_scripting(
@@ -118,6 +176,20 @@ class ModelArgs:
     max_seq_len: int = 1024
 
     gradient_checkpointing: bool = False
+    # fraction of transformer blocks to recompute in backward; 1.0 keeps the
+    # previous checkpoint-everything behavior, lower it (e.g. 0.5) to trade
+    # activation memory for up to ~33% of forward compute back
+    activation_checkpoint_ratio: float = 1.0
+
+    # opt-in: fullgraph compilation of the decode step has not been validated
+    # on the deployed stack, and a graph break there is a hard runtime error
+    compile_decode: bool = False
+    # off by default: existing checkpoints were trained untied, and tying at
+    # load time would silently overwrite the input embedding with the LM head
+    tie_word_embeddings: bool = False
+    # int8 weight-only LM head for decoding; needs torchao, see
+    # LLAMA.quantize_output_layer
+    quantize_output: bool = False
 
     use_lora: bool = True
     lora_r: int = 8
@@ -130,45 +202,64 @@ class ModelArgs:
     enable_fsdp: bool = False
 
 class RMSNorm(torch.nn.Module):
+    # class-level switch: set False to run the eager kernels instead;
+    # LLaMADecoder flips it before construction when FSDP is enabled, where
+    # the compiled graph cannot be traced
+    use_compile = True
+
     def __init__(self, dim: int, eps: float = 1e-6):
         super().__init__()
         self.eps = eps
         self.weight = nn.Parameter(torch.ones(dim))
+        if self.use_compile and hasattr(torch, "compile"):
+            # fuse the pow/mean/rsqrt/mul chain into one kernel so the
+            # activation makes a single round-trip through HBM
+            self._forward = torch.compile(
+                self._forward, mode="reduce-overhead", dynamic=True
+            )
 
     def _norm(self, x):
         return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
 
-    def forward(self, x):
-        output = self._norm(x.float()).type_as(x)
+    def _forward(self, x):
+        # fp16's ~65504 max overflows on x^2 for LLaMA's large residual
+        # activations, so that path keeps the FP32 round-trip; bf16 shares
+        # FP32's exponent range and is normalized in the compute dtype
+        if x.dtype == torch.float16:
+            output = self._norm(x.float()).type_as(x)
+        else:
+            output = self._norm(x)
         return output * self.weight
 
+    def forward(self, x):
+        return self._forward(x)
+
 
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
     freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
     t = torch.arange(end, device=freqs.device)  # type: ignore
     freqs = torch.outer(t, freqs).float()  # type: ignore
-    freqs_cis = torch.polar(torch.ones_like(freqs), freqs)  # complex64
-    return freqs_cis
-
-
-def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
-    ndim = x.ndim
-    assert 0 <= 1 < ndim
-    assert freqs_cis.shape == (x.shape[1], x.shape[-1])
-    shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
-    return freqs_cis.view(*shape)
+    return torch.cos(freqs), torch.sin(freqs)  # (end, dim // 2) each
 
 
 def apply_rotary_emb(
     xq: torch.Tensor,
     xk: torch.Tensor,
-    freqs_cis: torch.Tensor,
+    cos: torch.Tensor,
+    sin: torch.Tensor,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
-    xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
-    xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
-    freqs_cis = reshape_for_broadcast(freqs_cis, xq_)
-    xq_out = torch.view_as_real(xq_ * freqs_cis).flatten(3)
-    xk_out = torch.view_as_real(xk_ * freqs_cis).flatten(3)
+    # real-arithmetic rotation on interleaved (even, odd) pairs; avoids the
+    # complex64 round-trip so everything stays in the compute dtype
+    cos = cos[None, :, None, :]  # broadcast over (bsz, seqlen, n_heads, dim // 2)
+    sin = sin[None, :, None, :]
+    xq_r, xq_i = xq[..., 0::2], xq[..., 1::2]
+    xk_r, xk_i = xk[..., 0::2], xk[..., 1::2]
+    xq_out = torch.stack(
+        [xq_r * cos - xq_i * sin, xq_r * sin + xq_i * cos], dim=-1
+    ).flatten(-2)
+    xk_out = torch.stack(
+        [xk_r * cos - xk_i * sin, xk_r * sin + xk_i * cos], dim=-1
+    ).flatten(-2)
     return xq_out.type_as(xq), xk_out.type_as(xk)
 
 
@@ -179,19 +270,11 @@ class Attention_LoRA(nn.Module):
         self.n_local_heads = args.n_heads
         self.head_dim = args.dim // args.n_heads
 
-        self.wq = Linear(
+        # single fused projection for Q/K/V: one GEMM instead of three,
+        # reading the activation from HBM once
+        self.wqkv = Linear(
             args.dim,
-            args.n_heads * self.head_dim,
-            bias=False
-        )
-        self.wk = Linear(
-            args.dim,
-            args.n_heads * self.head_dim,
-            bias=False
-        )
-        self.wv = Linear(
-            args.dim,
-            args.n_heads * self.head_dim,
+            3 * args.n_heads * self.head_dim,
             bias=False
         )
         self.wo = Linear(
@@ -200,84 +283,147 @@ class Attention_LoRA(nn.Module):
             bias=False
         )
 
-        self.wq_lora_A = nn.Parameter(self.wq.weight.new_zeros((args.dim, args.lora_r)))
-        self.wq_lora_B = nn.Parameter(self.wq.weight.new_zeros((args.lora_r, args.dim)))
-        self.wk_lora_A = nn.Parameter(self.wk.weight.new_zeros((args.dim, args.lora_r)))
-        self.wk_lora_B = nn.Parameter(self.wk.weight.new_zeros((args.lora_r, args.dim)))
-        self.wv_lora_A = nn.Parameter(self.wv.weight.new_zeros((args.dim, args.lora_r)))
-        self.wv_lora_B = nn.Parameter(self.wv.weight.new_zeros((args.lora_r, args.dim)))
+        # Q/K/V LoRA matrices are fused so the down-projection reads x once
+        # (one GEMM) and the three up-projections run as a single bmm
+        self.lora_r = args.lora_r
+        self.qkv_lora_A = nn.Parameter(self.wqkv.weight.new_zeros((args.dim, 3 * args.lora_r)))
+        self.qkv_lora_B = nn.Parameter(self.wqkv.weight.new_zeros((3, args.lora_r, args.dim)))
         self.wo_lora_A = nn.Parameter(self.wo.weight.new_zeros((args.dim, args.lora_r)))
         self.wo_lora_B = nn.Parameter(self.wo.weight.new_zeros((args.lora_r, args.dim)))
         self.scaling = args.lora_alpha / args.lora_r
+        self._merged = False
 
         self.reset_parameters()
 
         if args.lora_dropout > 0.:
             self.lora_dropout = nn.Dropout(p=args.lora_dropout)
         else:
-            self.lora_dropout = lambda x: x
+            self.lora_dropout = nn.Identity()
 
-        # TODO use incremental states
-        # self.cache_k = torch.zeros(
-        #     (args.max_batch_size, args.max_seq_len, self.n_local_heads, self.head_dim)
-        # ).cuda()
-        # self.cache_v = torch.zeros(
-        #     (args.max_batch_size, args.max_seq_len, self.n_local_heads, self.head_dim)
-        # ).cuda()
+        # per-layer views into LLAMA.kv_cache, bound by _setup_kv_cache
+        self.cache_k = None
+        self.cache_v = None
 
     def reset_parameters(self):
-        nn.init.kaiming_uniform_(self.wq_lora_A, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.wk_lora_A, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.wv_lora_A, a=math.sqrt(5))
-        nn.init.kaiming_uniform_(self.wo_lora_A, a=math.sqrt(5))
-        nn.init.zeros_(self.wq_lora_B)
-        nn.init.zeros_(self.wk_lora_B)
-        nn.init.zeros_(self.wv_lora_B)
+        # draw the random init on CPU and copy in: avoids a curand launch per
+        # parameter and CUDA allocator churn when the model is built on GPU
+        with torch.no_grad():
+            for lora_A in (self.qkv_lora_A, self.wo_lora_A):
+                tmp = torch.empty(lora_A.shape, device="cpu", dtype=lora_A.dtype)
+                nn.init.kaiming_uniform_(tmp, a=math.sqrt(5))
+                lora_A.data.copy_(tmp, non_blocking=True)
+        nn.init.zeros_(self.qkv_lora_B)
         nn.init.zeros_(self.wo_lora_B)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # original LLaMA checkpoints ship separate wq/wk/wv projections
+        if prefix + "wq.weight" in state_dict:
+            state_dict[prefix + "wqkv.weight"] = torch.cat(
+                [state_dict.pop(prefix + "w%s.weight" % p) for p in "qkv"], dim=0
+            )
+        # older checkpoints store one LoRA pair per projection
+        if prefix + "wq_lora_A" in state_dict:
+            state_dict[prefix + "qkv_lora_A"] = torch.cat(
+                [state_dict.pop(prefix + "w%s_lora_A" % p) for p in "qkv"], dim=1
+            )
+            state_dict[prefix + "qkv_lora_B"] = torch.stack(
+                [state_dict.pop(prefix + "w%s_lora_B" % p) for p in "qkv"], dim=0
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _lora_deltas(self):
+        # effective weight deltas in Linear's (out, in) layout
+        r = self.lora_r
+        delta_qkv = torch.cat(
+            [
+                (self.qkv_lora_A[:, i * r : (i + 1) * r] @ self.qkv_lora_B[i]).t()
+                for i in range(3)
+            ],
+            dim=0,
+        )
+        delta_o = (self.wo_lora_A @ self.wo_lora_B).t()
+        return delta_qkv * self.scaling, delta_o * self.scaling
+
+    def merge_lora(self):
+        """Fold the LoRA deltas into the base weights (the PEFT
+        merge_and_unload pattern) so generation runs the plain projections
+        without the 6 extra adapter GEMMs per layer."""
+        if self._merged:
+            return
+        with torch.no_grad():
+            delta_qkv, delta_o = self._lora_deltas()
+            self.wqkv.weight.data.add_(delta_qkv.type_as(self.wqkv.weight))
+            self.wo.weight.data.add_(delta_o.type_as(self.wo.weight))
+        self._merged = True
+
+    def unmerge_lora(self):
+        """Subtract the LoRA deltas back out, e.g. before resuming training."""
+        if not self._merged:
+            return
+        with torch.no_grad():
+            delta_qkv, delta_o = self._lora_deltas()
+            self.wqkv.weight.data.sub_(delta_qkv.type_as(self.wqkv.weight))
+            self.wo.weight.data.sub_(delta_o.type_as(self.wo.weight))
+        self._merged = False
+
+    def train(self, mode: bool = True):
+        # forward_generate merges the adapters for eval; undo the merge when
+        # returning to training (e.g. after generate-during-validation) so
+        # the LoRA parameters keep receiving gradients
+        if mode and self._merged:
+            self.unmerge_lora()
+        return super().train(mode)
+
+    def _lora_qkv(self, x):
+        bsz, seqlen, _ = x.shape
+        # dropout is a no-op at eval, so skip the call entirely at generation
+        # time rather than paying for a pass-through module per step
+        if self.training:
+            x = self.lora_dropout(x)
+        low = x @ self.qkv_lora_A  # (bsz, seqlen, 3 * r)
+        low = low.view(bsz * seqlen, 3, self.lora_r).transpose(0, 1)  # (3, bsz * seqlen, r)
+        up = torch.bmm(low, self.qkv_lora_B).view(3, bsz, seqlen, -1)
+        return up * self.scaling
+
     def _checkpointed_forward(self, x):
-        xq = self.wq(x) + (self.lora_dropout(x) @ self.wq_lora_A @ self.wq_lora_B) * self.scaling
-        xk = self.wk(x) + (self.lora_dropout(x) @ self.wk_lora_A @ self.wk_lora_B) * self.scaling
-        xv = self.wv(x) + (self.lora_dropout(x) @ self.wv_lora_A @ self.wv_lora_B) * self.scaling
-        return xq, xk, xv
-    
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], 
-                incremental_state=None, gradient_checkpointing=False, layer_id=None):
+        lora_q, lora_k, lora_v = self._lora_qkv(x)
+        xq, xk, xv = self.wqkv(x).split(self.n_local_heads * self.head_dim, dim=-1)
+        return xq + lora_q, xk + lora_k, xv + lora_v
+
+    def _update_kv_cache(self, xk, xv, incremental_state):
+        # cache_k/cache_v are this layer's views into the stacked
+        # LLAMA.kv_cache, bound once per generation by _setup_kv_cache
+        seqlen = xk.shape[1]
+        end_pos = incremental_state.get("end_pos", 0)
+        self.cache_k[:, end_pos : end_pos + seqlen] = xk
+        self.cache_v[:, end_pos : end_pos + seqlen] = xv
+        incremental_state["end_pos"] = end_pos + seqlen
+        return (
+            self.cache_k[:, : end_pos + seqlen],
+            self.cache_v[:, : end_pos + seqlen],
+        )
+
+    def forward(self, x: torch.Tensor, start_pos: int, rope_cos: torch.Tensor, rope_sin: torch.Tensor,
+                mask: Optional[torch.Tensor], incremental_state=None, gradient_checkpointing=False, layer_id=None):
 
         bsz, seqlen, _ = x.shape
 
-        xq = self.wq(x) + (self.lora_dropout(x) @ self.wq_lora_A @ self.wq_lora_B) * self.scaling
-        xk = self.wk(x) + (self.lora_dropout(x) @ self.wk_lora_A @ self.wk_lora_B) * self.scaling
-        xv = self.wv(x) + (self.lora_dropout(x) @ self.wv_lora_A @ self.wv_lora_B) * self.scaling
+        xq, xk, xv = self.wqkv(x).split(self.n_local_heads * self.head_dim, dim=-1)
+        if not self._merged:
+            lora_q, lora_k, lora_v = self._lora_qkv(x)
+            xq = xq + lora_q
+            xk = xk + lora_k
+            xv = xv + lora_v
 
         xq = xq.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         xk = xk.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         xv = xv.view(bsz, seqlen, self.n_local_heads, self.head_dim)
 
-        xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
+        xq, xk = apply_rotary_emb(xq, xk, rope_cos, rope_sin)
 
         if incremental_state is not None:
-            if "prev_key" in incremental_state:
-                prev_key = incremental_state["prev_key"].view(
-                    bsz, -1, self.n_local_heads, self.head_dim
-                )
-                prev_value = incremental_state["prev_value"].view(
-                    bsz, -1, self.n_local_heads, self.head_dim
-                )
-
-                xk = torch.cat([prev_key, xk], dim=1)
-                xv = torch.cat([prev_value, xv], dim=1)
-                #print ("test1")
+            xk, xv = self._update_kv_cache(xk, xv, incremental_state)
 
-            incremental_state["prev_key"] = xk.view(
-                bsz, -1, self.n_local_heads, self.head_dim
-            )
-            incremental_state["prev_value"] = xv.view(
-                bsz, -1, self.n_local_heads, self.head_dim
-            )
-            #src_len = k.size(1)
- 
-               
         keys = xk
         values = xv
 
@@ -285,18 +431,22 @@ class Attention_LoRA(nn.Module):
         keys = keys.transpose(1, 2)
         values = values.transpose(1, 2)
 
-        scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
-        # print("scores: ", scores.shape)
-        if mask is not None:
-            scores = scores + mask  # (bs, n_local_heads, slen, cache_len + slen)
-
-        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-        output = torch.matmul(scores, values)  # (bs, n_local_heads, slen, head_dim)
-        output = output.transpose(
-            1, 2
-        ).contiguous().view(bsz, seqlen, -1)
-
-        return self.wo(output) + (self.lora_dropout(output) @ self.wo_lora_A @ self.wo_lora_B) * self.scaling
+        # fused attention kernel (FlashAttention / mem-efficient), never
+        # materializes the (bs, n_local_heads, slen, cache_len + slen) scores
+        output = F.scaled_dot_product_attention(
+            xq, keys, values,
+            attn_mask=mask,
+            dropout_p=0.0,
+            is_causal=mask is None and seqlen > 1,
+        )  # (bs, n_local_heads, slen, head_dim)
+        # reshape only copies if the strides require it, unlike the
+        # unconditional contiguous() copy this replaced
+        output = output.transpose(1, 2).reshape(bsz, seqlen, -1)
+
+        if self._merged:
+            return self.wo(output)
+        lora_in = self.lora_dropout(output) if self.training else output
+        return self.wo(output) + (lora_in @ self.wo_lora_A @ self.wo_lora_B) * self.scaling
 
 
 class Attention(nn.Module):
@@ -306,19 +456,11 @@ class Attention(nn.Module):
         self.n_local_heads = args.n_heads
         self.head_dim = args.dim // args.n_heads
 
-        self.wq = Linear(
+        # single fused projection for Q/K/V: one GEMM instead of three,
+        # reading the activation from HBM once
+        self.wqkv = Linear(
             args.dim,
-            args.n_heads * self.head_dim,
-            bias=False
-        )
-        self.wk = Linear(
-            args.dim,
-            args.n_heads * self.head_dim,
-            bias=False
-        )
-        self.wv = Linear(
-            args.dim,
-            args.n_heads * self.head_dim,
+            3 * args.n_heads * self.head_dim,
             bias=False
         )
         self.wo = Linear(
@@ -327,80 +469,96 @@ class Attention(nn.Module):
             bias=False
         )
 
-        # TODO use incremental states
-        # self.cache_k = torch.zeros(
-        #     (args.max_batch_size, args.max_seq_len, self.n_local_heads, self.head_dim)
-        # ).cuda()
-        # self.cache_v = torch.zeros(
-        #     (args.max_batch_size, args.max_seq_len, self.n_local_heads, self.head_dim)
-        # ).cuda()
+        # per-layer views into LLAMA.kv_cache, bound by _setup_kv_cache
+        self.cache_k = None
+        self.cache_v = None
 
         self.flash_attention = args.flash_attention
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # original LLaMA checkpoints ship separate wq/wk/wv projections
+        if prefix + "wq.weight" in state_dict:
+            state_dict[prefix + "wqkv.weight"] = torch.cat(
+                [state_dict.pop(prefix + "w%s.weight" % p) for p in "qkv"], dim=0
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _checkpointed_forward(self, x):
-        return self.wq(x), self.wk(x), self.wv(x)
+        return self.wqkv(x).split(self.n_local_heads * self.head_dim, dim=-1)
+
+    def _update_kv_cache(self, xk, xv, incremental_state):
+        # cache_k/cache_v are this layer's views into the stacked
+        # LLAMA.kv_cache, bound once per generation by _setup_kv_cache
+        seqlen = xk.shape[1]
+        end_pos = incremental_state.get("end_pos", 0)
+        self.cache_k[:, end_pos : end_pos + seqlen] = xk
+        self.cache_v[:, end_pos : end_pos + seqlen] = xv
+        incremental_state["end_pos"] = end_pos + seqlen
+        return (
+            self.cache_k[:, : end_pos + seqlen],
+            self.cache_v[:, : end_pos + seqlen],
+        )
 
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, 
+    def forward(self, x: torch.Tensor, start_pos: int, rope_cos: torch.Tensor, rope_sin: torch.Tensor,
                 mask: Optional[torch.Tensor], incremental_state=None, gradient_checkpointing=False):
 
         bsz, seqlen, _ = x.shape
         if gradient_checkpointing and self.training:
             xq, xk, xv = cp.checkpoint(self._checkpointed_forward, x)
         else:
-            xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
+            xq, xk, xv = self.wqkv(x).split(self.n_local_heads * self.head_dim, dim=-1)
 
         xq = xq.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         xk = xk.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         xv = xv.view(bsz, seqlen, self.n_local_heads, self.head_dim)
 
-        xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
+        xq, xk = apply_rotary_emb(xq, xk, rope_cos, rope_sin)
 
         if incremental_state is not None:
-            if "prev_key" in incremental_state:
-                prev_key = incremental_state["prev_key"].view(
-                    bsz, -1, self.n_local_heads, self.head_dim
-                )
-                prev_value = incremental_state["prev_value"].view(
-                    bsz, -1, self.n_local_heads, self.head_dim
-                )
-                xk = torch.cat([prev_key, xk], dim=1)
-                xv = torch.cat([prev_value, xv], dim=1)
-                #print ("test1")
-            incremental_state["prev_key"] = xk.view(
-                bsz, -1, self.n_local_heads, self.head_dim
-            )
-            incremental_state["prev_value"] = xv.view(
-                bsz, -1, self.n_local_heads, self.head_dim
-            )
-            #src_len = k.size(1)
- 
-        if self.flash_attention:
-            # attn_bias = LowerTriangularMask()
-            attn_bias = mask
+            xk, xv = self._update_kv_cache(xk, xv, incremental_state)
+
+        if self.flash_attention and memory_efficient_attention is not None and (
+            seqlen == 1 or xk.shape[1] == seqlen
+        ):
+            # masks only ever encode causality now, so the xformers path uses
+            # its dedicated causal bias instead of a materialized tensor;
+            # LowerTriangularMask is top-left aligned, so multi-token queries
+            # over a non-empty cache fall through to the SDPA branch below
+            attn_bias = LowerTriangularMask() if seqlen > 1 else None
             attn = memory_efficient_attention(xq, xk, xv, attn_bias, op=MemoryEfficientAttentionCutlassOp)  # B M H K
-            attn = attn.contiguous().view(bsz, seqlen, -1)
+            attn = attn.reshape(bsz, seqlen, -1)
             return self.wo(attn)
-        else: 
+        else:
             keys = xk
             values = xv
 
             xq = xq.transpose(1, 2)
             keys = keys.transpose(1, 2)
             values = values.transpose(1, 2)
-            #print ("xq: ", xq.shape)
-            #print ("keys: ", keys.shape)
-            scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
+            # fused attention kernel (FlashAttention / mem-efficient), never
+            # materializes the (bs, n_local_heads, slen, cache_len + slen) scores
+            output = F.scaled_dot_product_attention(
+                xq, keys, values,
+                attn_mask=mask,
+                dropout_p=0.0,
+                is_causal=mask is None and seqlen > 1,
+            )  # (bs, n_local_heads, slen, head_dim)
+            # reshape only copies if the strides require it, unlike the
+            # unconditional contiguous() copy this replaced
+            output = output.transpose(1, 2).reshape(bsz, seqlen, -1)
+
+            return self.wo(output)
 
-            if mask is not None:
-                scores = scores + mask  # (bs, n_local_heads, slen, cache_len + slen)
 
-            scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-            output = torch.matmul(scores, values)  # (bs, n_local_heads, slen, head_dim)
-            output = output.transpose(
-                1, 2
-            ).contiguous().view(bsz, seqlen, -1)
+def _swiglu(gate_up):
+    gate, up = gate_up.chunk(2, dim=-1)
+    return F.silu(gate) * up
 
-            return self.wo(output)
+
+if hasattr(torch, "compile"):
+    # fuse chunk + silu + mul into one kernel so the hidden-dim activation
+    # makes a single round-trip through HBM
+    _swiglu = torch.compile(_swiglu, mode="reduce-overhead", dynamic=True)
 
 
 class FeedForward(nn.Module):
@@ -414,25 +572,32 @@ class FeedForward(nn.Module):
         hidden_dim = int(2 * hidden_dim / 3)
         hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
 
-        self.w1 = Linear(
-            dim, hidden_dim, bias=False
+        # gate (w1) and up (w3) projections fused into one GEMM
+        self.w13 = Linear(
+            dim, 2 * hidden_dim, bias=False
         )
         self.w2 = Linear(
             hidden_dim, dim, bias=False
         )
-        self.w3 = Linear(
-            dim, hidden_dim, bias=False
-        )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # original LLaMA checkpoints ship separate w1/w3 projections
+        if prefix + "w1.weight" in state_dict:
+            state_dict[prefix + "w13.weight"] = torch.cat(
+                [state_dict.pop(prefix + "w1.weight"), state_dict.pop(prefix + "w3.weight")],
+                dim=0,
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, gradient_checkpointing):
         if gradient_checkpointing and self.training:
             output = cp.checkpoint(self._checkpointed_forward, x)
         else:
-            output = self.w2(F.silu(self.w1(x)) * self.w3(x))
+            output = self.w2(_swiglu(self.w13(x)))
         return output
 
     def _checkpointed_forward(self, x):
-        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+        return self.w2(_swiglu(self.w13(x)))
 
 
 class TransformerBlock(nn.Module):
@@ -454,24 +619,9 @@ class TransformerBlock(nn.Module):
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
 
-        wrapping_policy = get_llama_wrapper()
-        fpSixteen = MixedPrecision(
-            param_dtype=torch.float16,
-            reduce_dtype=torch.float16,
-            buffer_dtype=torch.float16
-        )
-        if args.enable_fsdp:
-            self.feed_forward = FSDP(
-                self.feed_forward,
-                auto_wrap_policy = wrapping_policy,
-                device_id=torch.cuda.current_device(),
-                limit_all_gathers=True,
-                mixed_precision=fpSixteen,
-                # cpu_offload=CPUOffload(offload_params=True),
-            )
-
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], incremental_state=None,):
-        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask, incremental_state, layer_id=self.layer_id)
+    def forward(self, x: torch.Tensor, start_pos: int, rope_cos: torch.Tensor, rope_sin: torch.Tensor,
+                mask: Optional[torch.Tensor], incremental_state=None,):
+        h = x + self.attention.forward(self.attention_norm(x), start_pos, rope_cos, rope_sin, mask, incremental_state, layer_id=self.layer_id)
         ffn_output = self.feed_forward.forward(self.ffn_norm(h), self.ffn_gradient_checkpointing)
         out = h + ffn_output
         return out
@@ -496,72 +646,201 @@ class LLAMA(nn.Module):
         self.output = Linear(
             params.dim, params.vocab_size, bias=False
         )
+        if params.tie_word_embeddings:
+            # share the (vocab_size, dim) matrix between the input embedding
+            # and the vocab projection: halves its memory footprint and FSDP
+            # treats it as one parameter (requires use_orig_params=True)
+            self.output.weight = self.tok_embeddings.weight
 
-        self.freqs_cis = precompute_freqs_cis(
+        rope_cos, rope_sin = precompute_freqs_cis(
             self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
         )
+        # buffers so they move with .cuda()/.to() and follow FSDP mixed-precision casting
+        self.register_buffer("rope_cos", rope_cos, persistent=False)
+        self.register_buffer("rope_sin", rope_sin, persistent=False)
+
+        # cached boolean causal mask (True = may attend), sliced instead of
+        # rebuilding a -inf mask on every prefill
+        self.register_buffer(
+            "causal_mask",
+            torch.tril(torch.ones(
+                self.params.max_seq_len * 2, self.params.max_seq_len * 2, dtype=torch.bool
+            )),
+            persistent=False,
+        )
+
+        # stacked (n_layers * 2, bsz, seq, n_heads, head_dim) KV cache shared
+        # by all layers, lazily allocated in _setup_kv_cache
+        self.kv_cache = None
+
+        if params.compile_decode and hasattr(torch, "compile"):
+            # the seqlen==1 decode step is launch-overhead bound: capture it
+            # as one graph instead of n_layers * k small kernel launches
+            self._decode_step = torch.compile(
+                self._decode_step, mode="reduce-overhead", fullgraph=True
+            )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.params.tie_word_embeddings:
+            # broadcast one matrix to both keys if only one is present, and
+            # refuse to silently collapse two genuinely different matrices
+            # into the shared parameter
+            emb = state_dict.get(prefix + "tok_embeddings.weight")
+            out = state_dict.get(prefix + "output.weight")
+            if emb is not None and out is None:
+                state_dict[prefix + "output.weight"] = emb
+            elif out is not None and emb is None:
+                state_dict[prefix + "tok_embeddings.weight"] = out
+            elif emb is not None and out is not None and not torch.equal(emb, out):
+                raise RuntimeError(
+                    "tie_word_embeddings=True but the checkpoint carries "
+                    "different tok_embeddings.weight and output.weight; "
+                    "load it with tie_word_embeddings=False"
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def freeze_module(self, module):
         for param in module.parameters():
             param.requires_grad = False
 
+    def merge_lora(self):
+        for layer in self.layers:
+            attention = layer.attention
+            if hasattr(attention, "merge_lora"):
+                attention.merge_lora()
+
+    def unmerge_lora(self):
+        for layer in self.layers:
+            attention = layer.attention
+            if hasattr(attention, "unmerge_lora"):
+                attention.unmerge_lora()
+
     def get_text_embedding(self, text):
         return self.tok_embeddings(text)
 
+    def quantize_output_layer(self):
+        """int8 weight-only (W8A16) quantization of the vocab projection.
+
+        At seqlen == 1 decode this is a memory-bound GEMV over the largest
+        weight in the model, so halving its bytes roughly doubles its speed;
+        the LM head is robust to 8-bit weights. Call after the checkpoint is
+        loaded and the model has been moved to its inference device.
+        """
+        if quantize_ is None:
+            print("torchao not available, keeping the LM head unquantized")
+            return
+        if self.params.tie_word_embeddings:
+            # untie first so the embedding lookup stays in the compute dtype
+            self.output.weight = nn.Parameter(self.output.weight.data.clone())
+        quantize_(self.output, int8_weight_only())
+
     def forward_generate(self, prev_output_tokens, start_pos, audio_out, left_prompts=None, incremental_state=None):
-        with torch.no_grad():
-            if audio_out is not None:
-
-                if start_pos == 0:
-                    if left_prompts is not None:
-                        left_h = self.tok_embeddings(left_prompts)
-                    h = self.tok_embeddings(prev_output_tokens)
-                    if left_prompts is not None:
-                        h = torch.cat((left_h, audio_out["encoder_out"], h), dim=1)
-                    else:
-                        h = torch.cat((audio_out["encoder_out"], h), dim=1)
+        out = self._forward_generate(prev_output_tokens, start_pos, audio_out, left_prompts, incremental_state)
+        # the sequence generator runs under plain no_grad and updates the
+        # logits in place (temperature div_), which is not allowed on
+        # inference tensors, so hand back a normal tensor
+        return out.clone()
+
+    # inference_mode also skips version-counter and view-metadata tracking
+    # that torch.no_grad still pays for on every op of the decode loop
+    @torch.inference_mode()
+    def _forward_generate(self, prev_output_tokens, start_pos, audio_out, left_prompts=None, incremental_state=None):
+        if audio_out is not None:
+
+            if start_pos == 0:
+                if left_prompts is not None:
+                    left_h = self.tok_embeddings(left_prompts)
+                h = self.tok_embeddings(prev_output_tokens)
+                if left_prompts is not None:
+                    h = torch.cat((left_h, audio_out["encoder_out"], h), dim=1)
                 else:
-                    prev_output_tokens = prev_output_tokens[:, -1:]
-                    if left_prompts is not None:
-                        start_pos = start_pos + left_prompts.shape[1] + audio_out["encoder_out"].shape[1]
-                    else:
-                        start_pos = start_pos + audio_out["encoder_out"].shape[1]
-                    h = self.tok_embeddings(prev_output_tokens)
+                    h = torch.cat((audio_out["encoder_out"], h), dim=1)
             else:
-                if start_pos == 0:
-                    h = self.tok_embeddings(prev_output_tokens)
+                prev_output_tokens = prev_output_tokens[:, -1:]
+                if left_prompts is not None:
+                    start_pos = start_pos + left_prompts.shape[1] + audio_out["encoder_out"].shape[1]
                 else:
-                    prev_output_tokens = prev_output_tokens[:, -1:]
-                    h = self.tok_embeddings(prev_output_tokens)
-
-            _bsz, seqlen, _ = h.shape
-            freqs_cis = self.freqs_cis.to(h.device)
-            freqs_cis = freqs_cis[start_pos : start_pos + seqlen]
-            mask = None
-            if seqlen > 1:
-                mask = torch.full((1, 1, seqlen, seqlen), float("-inf"), device=h.device)
-                mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
-
-            #start_pos = 0
-            for i in range(self.n_layers):
-                if i not in incremental_state:
-                    incremental_state[i] = {}
-                h = self.layers[i](h, start_pos, freqs_cis, mask, incremental_state[i])
+                    start_pos = start_pos + audio_out["encoder_out"].shape[1]
+                h = self.tok_embeddings(prev_output_tokens)
+        else:
+            if start_pos == 0:
+                h = self.tok_embeddings(prev_output_tokens)
+            else:
+                prev_output_tokens = prev_output_tokens[:, -1:]
+                h = self.tok_embeddings(prev_output_tokens)
+
+        for i in range(self.n_layers):
+            if i not in incremental_state:
+                incremental_state[i] = {}
+        if "end_pos" not in incremental_state[0]:
+            self._setup_kv_cache(h.shape[0], h.device, h.dtype)
+
+        if h.shape[1] == 1:
+            h = self._decode_step(h, start_pos, incremental_state)
+        else:
+            h = self._prefill(h, start_pos, incremental_state)
 
         h = self.norm(h)
-        
+
         out = self.output(h)
         return out
 
+    def _setup_kv_cache(self, bsz, device, dtype):
+        if (
+            self.kv_cache is None
+            or self.kv_cache.shape[1] != bsz
+            or self.kv_cache.device != device
+            or self.kv_cache.dtype != dtype
+        ):
+            head_dim = self.params.dim // self.params.n_heads
+            self.kv_cache = torch.empty(
+                (self.n_layers * 2, bsz, self.params.max_seq_len * 2, self.params.n_heads, head_dim),
+                device=device, dtype=dtype,
+            )
+        self._rebind_kv_cache_views()
+
+    def _rebind_kv_cache_views(self):
+        for i, layer in enumerate(self.layers):
+            layer.attention.cache_k = self.kv_cache[2 * i]
+            layer.attention.cache_v = self.kv_cache[2 * i + 1]
+
+    def _prefill(self, h, start_pos, incremental_state):
+        # variable-length prompt path, run eagerly
+        _bsz, seqlen, _ = h.shape
+        # rope_cos/rope_sin are buffers and already live on the model's
+        # device; slicing directly avoids a device check every decode step
+        rope_cos = self.rope_cos[start_pos : start_pos + seqlen]
+        rope_sin = self.rope_sin[start_pos : start_pos + seqlen]
+        mask = None
+        if seqlen > 1 and start_pos > 0:
+            # offset prefill: slice the cached boolean mask, keeping columns
+            # for the start_pos cached positions so it matches SDPA's (L, S);
+            # at start_pos == 0 the modules use SDPA's is_causal kernel instead
+            mask = self.causal_mask[start_pos : start_pos + seqlen, : start_pos + seqlen]
+
+        for i in range(self.n_layers):
+            h = self.layers[i](h, start_pos, rope_cos, rope_sin, mask, incremental_state[i])
+        return h
+
+    def _decode_step(self, h, start_pos, incremental_state):
+        # fixed seqlen == 1, no mask: this is the shape-stable hot loop that
+        # torch.compile captures (see __init__)
+        rope_cos = self.rope_cos[start_pos : start_pos + 1]
+        rope_sin = self.rope_sin[start_pos : start_pos + 1]
+        for i in range(self.n_layers):
+            h = self.layers[i](h, start_pos, rope_cos, rope_sin, None, incremental_state[i])
+        return h
+
     def reorder_incremental_state_scripting(
         self,
         incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
         new_order: Tensor,
     ):
-        for key in incremental_state:
-            for param_name in incremental_state[key]:
-                if incremental_state[key][param_name] is not None:
-                    incremental_state[key][param_name] = incremental_state[key][param_name].index_select(0, new_order)
+        # incremental_state only tracks "end_pos" now; all layers' K and V
+        # caches are reordered with one fused gather on the stacked tensor
+        if self.kv_cache is not None:
+            self.kv_cache = self.kv_cache.index_select(1, new_order)
+            self._rebind_kv_cache_views()
 
 
 class Tokenizer:
@@ -253,6 +253,14 @@ class SpeechLLMModel(BaseFairseqModel):
         """Build a new model instance."""
         return cls(cfg, task)
 
+    def prepare_for_inference_(self, cfg):
+        super().prepare_for_inference_(cfg)
+        # runs after checkpoint load and device placement, so quantizing the
+        # LM head here sees the final weights
+        model_llama = self.gpt_model.model_llama
+        if model_llama.params.quantize_output:
+            model_llama.quantize_output_layer()
+
     def get_targets(self, sample, net_output):
         return sample['target'][sample['net_input']['target_masks']]
 